@@ -12,19 +12,29 @@ Run via cron or scheduled task to accumulate historical data over time.
 """
 
 import argparse
+import collections
 import csv
+import functools
 import os
+import pickle
 import sys
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 
+import orjson
 import requests
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 CSV_FILE = os.path.join(SCRIPT_DIR, "auto_train_status.csv")
+# Pickled recorded-keys set, tagged with the fingerprint of the CSV it was built from
+INDEX_FILE = os.path.join(SCRIPT_DIR, "auto_train_status.idx")
+# Trailing CSV bytes kept in the fingerprint, so a same-size rewrite with a
+# preserved mtime (cp -p, rsync -t) still invalidates the index
+INDEX_TAIL_BYTES = 256
 
 TRAIN_CONFIG = {
-    53: {"route": "LOR → SFA", "stations": ["LOR", "SFA"]},
-    52: {"route": "SFA → LOR", "stations": ["SFA", "LOR"]},
+    53: {"route": "LOR → SFA", "stations": ("LOR", "SFA")},
+    52: {"route": "SFA → LOR", "stations": ("SFA", "LOR")},
 }
 
 CSV_HEADERS = [
@@ -41,80 +51,168 @@ CSV_HEADERS = [
     "source",
 ]
 
+Row = collections.namedtuple("Row", CSV_HEADERS)
+
 HTTP_HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
     "Accept": "application/json",
 }
 
+# One session (one connection pool, common headers) for all Amtraker requests;
+# closed at the end of main(). requests.Session isn't documented as thread-safe,
+# but concurrent plain GETs like run()'s only touch the thread-safe urllib3 pool
+SESSION = requests.Session()
+SESSION.headers.update(HTTP_HEADERS)
+
 
 def init_csv():
     """Create CSV with headers if it doesn't exist."""
-    if not os.path.exists(CSV_FILE):
-        with open(CSV_FILE, "w", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-            writer.writeheader()
-
-
-def date_already_recorded(date_str, station, train_num):
-    """Check if a date+station+train combo is already in the CSV."""
-    if not os.path.exists(CSV_FILE):
-        return False
-    with open(CSV_FILE, "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row["date"] == date_str and row["station"] == station and str(row["train_num"]) == str(train_num):
-                return True
-    return False
-
-
-def append_rows(rows):
-    """Append rows to the CSV file."""
+    # O_EXCL lets the open itself decide whether the file is new, with no exists() race
+    try:
+        fd = os.open(CSV_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, "w", newline="") as f:
+        csv.writer(f).writerow(CSV_HEADERS)
+
+
+def load_recorded_keys():
+    """Load the (date, station, train_num) combos already in the CSV into a set.
+
+    Uses the sidecar index when it matches the CSV's fingerprint; otherwise
+    rescans the CSV. main() rewrites the index once at the end of the run.
+    """
+    fingerprint = _csv_fingerprint()
+    if fingerprint is None:
+        return set()
+
+    try:
+        with open(INDEX_FILE, "rb") as f:
+            index = pickle.load(f)
+        if index["fingerprint"] == fingerprint:
+            return set(index["keys"])
+    except Exception:
+        pass  # Missing, stale-format, or corrupt index; rescan below
+
+    return _scan_recorded_keys()
+
+
+def save_recorded_keys(recorded):
+    """Write the recorded-keys index for the CSV as it is now."""
+    fingerprint = _csv_fingerprint()
+    if fingerprint is None:
+        return
+    tmp_path = INDEX_FILE + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"fingerprint": fingerprint, "keys": recorded}, f, protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(tmp_path, INDEX_FILE)
+    except OSError as e:
+        print(f"  Could not write index {INDEX_FILE}: {e}")
+
+
+def _csv_fingerprint():
+    """Return (mtime_ns, size, trailing bytes) of the CSV, or None if it doesn't exist."""
+    try:
+        f = open(CSV_FILE, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        st = os.fstat(f.fileno())
+        f.seek(max(0, st.st_size - INDEX_TAIL_BYTES))
+        return (st.st_mtime_ns, st.st_size, f.read(INDEX_TAIL_BYTES))
+
+
+def _scan_recorded_keys():
+    """Read the recorded (date, station, train_num) keys from the CSV."""
+    with open(CSV_FILE, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Skip header
+        return {(row[0], row[2], row[1]) for row in reader if len(row) >= 3}
+
+
+def append_rows(rows, recorded, out_dates=None):
+    """Append Row tuples to the CSV file in one write and add their keys to the recorded set.
+
+    If out_dates is given, the date of every written row is added to it.
+    """
     with open(CSV_FILE, "a", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-        for row in rows:
-            writer.writerow(row)
+        writer = csv.writer(f)
+        writer.writerows(rows)
+        f.flush()
+        os.fsync(f.fileno())
+    for row in rows:
+        recorded.add((row.date, row.station, str(row.train_num)))
+        if out_dates is not None:
+            out_dates.add(row.date)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_dt(value):
+    """Parse an ISO datetime string, returning None if it isn't valid.
+
+    Cached because the same scheduled times show up for every station and run.
+    Callers must pass a str; anything unhashable fails in the cache lookup.
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
 
 
 def parse_delay_minutes(scheduled, actual):
     """Calculate delay in minutes between two ISO datetime strings."""
+    # Non-strings would raise in _parse_dt's lru_cache key lookup
+    if not isinstance(scheduled, str) or not isinstance(actual, str):
+        return None
     if not scheduled or not actual:
         return None
-    try:
-        sch = datetime.fromisoformat(scheduled)
-        act = datetime.fromisoformat(actual)
-        # Strip timezone info if only one has it
-        if sch.tzinfo and not act.tzinfo:
-            sch = sch.replace(tzinfo=None)
-        elif act.tzinfo and not sch.tzinfo:
-            act = act.replace(tzinfo=None)
-        delta = (act - sch).total_seconds() / 60
-        return round(delta)
-    except Exception:
+    sch = _parse_dt(scheduled)
+    act = _parse_dt(actual)
+    if sch is None or act is None:
         return None
+    # Strip timezone info if only one has it
+    if sch.tzinfo and not act.tzinfo:
+        sch = sch.replace(tzinfo=None)
+    elif act.tzinfo and not sch.tzinfo:
+        act = act.replace(tzinfo=None)
+    delta = (act - sch).total_seconds() / 60
+    return round(delta)
 
 
-def fetch_realtime(train_num, stations):
+def fetch_realtime(train_num, stations, stations_set):
     """Fetch current train status from Amtraker v3 API.
 
-    Returns a list of row dicts, or an empty list if the train isn't active.
+    stations is the ordered route (origin first); stations_set is the same
+    codes as a frozenset for filtering.
+
+    Returns (rows, message): rows is a list of Row tuples, empty if the train
+    isn't active or the request failed, and message explains why (else None).
+    Runs on worker threads, so it leaves printing to the caller.
     """
     url = f"https://api-v3.amtraker.com/v3/trains/{train_num}"
+    # Bodies the API sends for an inactive train; no need to parse them
+    empty_bodies = (b"{}", b"[]", b'{"%d":[]}' % train_num)
     try:
-        resp = requests.get(url, headers=HTTP_HEADERS, timeout=15)
+        resp = SESSION.get(url, timeout=15)
         resp.raise_for_status()
-        data = resp.json()
+        body = resp.content.strip()
+        if body in empty_bodies:
+            return [], f"Train {train_num} is not currently active."
+        data = orjson.loads(body)
     except Exception as e:
-        print(f"  Real-time API error for Train {train_num}: {e}")
-        return []
+        return [], f"Real-time API error for Train {train_num}: {e}"
 
     # The API returns a dict keyed by train number, value is a list of train instances
     trains = data if isinstance(data, list) else data.get(str(train_num), [])
     if not trains:
-        print(f"  Train {train_num} is not currently active.")
-        return []
+        return [], f"Train {train_num} is not currently active."
 
     # Determine the origin station (first station in the route) for deriving service date
     origin_station = stations[0]
+    today = datetime.now().strftime("%Y-%m-%d")
 
     rows = []
     for train in trains:
@@ -123,7 +221,7 @@ def fetch_realtime(train_num, stations):
 
         for stn in train_stations:
             code = stn.get("code", "")
-            if code not in stations:
+            if not isinstance(code, str) or code not in stations_set:
                 continue
 
             sch_arr = stn.get("schArr", "")
@@ -131,64 +229,96 @@ def fetch_realtime(train_num, stations):
             act_arr = stn.get("arr", "")
             act_dep = stn.get("dep", "")
 
-            # Derive service date from scheduled departure at origin station
+            # Derive service date from scheduled departure at origin station;
+            # ISO strings start with YYYY-MM-DD, so only the date part is parsed
             if code == origin_station and sch_dep:
                 try:
-                    train_date = datetime.fromisoformat(sch_dep).strftime("%Y-%m-%d")
-                except Exception:
-                    train_date = datetime.now().strftime("%Y-%m-%d")
+                    train_date = date.fromisoformat(sch_dep[:10]).isoformat()
+                except (TypeError, ValueError):
+                    train_date = today
 
             if not train_date:
-                train_date = datetime.now().strftime("%Y-%m-%d")
-
-            rows.append({
-                "date": train_date,
-                "train_num": train_num,
-                "station": code,
-                "scheduled_arrival": sch_arr or "",
-                "actual_arrival": act_arr or "",
-                "arrival_delay_mins": parse_delay_minutes(sch_arr, act_arr) if sch_arr and act_arr else "",
-                "scheduled_departure": sch_dep or "",
-                "actual_departure": act_dep or "",
-                "departure_delay_mins": parse_delay_minutes(sch_dep, act_dep) if sch_dep and act_dep else "",
-                "status": stn.get("status", ""),
-                "source": "amtraker_v3",
-            })
-
-    return rows
-
-
-def run(target_date=None):
+                train_date = today
+
+            rows.append(Row(
+                date=train_date,
+                train_num=train_num,
+                station=code,
+                scheduled_arrival=sch_arr or "",
+                actual_arrival=act_arr or "",
+                arrival_delay_mins=parse_delay_minutes(sch_arr, act_arr) if sch_arr and act_arr else "",
+                scheduled_departure=sch_dep or "",
+                actual_departure=act_dep or "",
+                departure_delay_mins=parse_delay_minutes(sch_dep, act_dep) if sch_dep and act_dep else "",
+                status=stn.get("status", ""),
+                source="amtraker_v3",
+            ))
+
+    return rows, None
+
+
+def run(recorded, target_date=None):
     """Fetch current train status for all trains from the real-time API.
 
-    If target_date is specified, only records matching that date are saved.
+    recorded is the set of (date, station, train_num) keys already in the CSV.
+    If target_date is specified, only records matching that date are saved,
+    and trains already recorded for that date are not fetched at all.
     """
-    for train_num, config in TRAIN_CONFIG.items():
-        stations = config["stations"]
-        route = config["route"]
-        print(f"\nFetching status for Train {train_num} ({route})")
-
-        rows = fetch_realtime(train_num, stations)
+    trains = TRAIN_CONFIG
+    if target_date:
+        needed = {
+            (target_date, s, str(t)) for t, c in TRAIN_CONFIG.items() for s in c["stations"]
+        } - recorded
+        if not needed:
+            print(f"All trains already recorded for {target_date}.")
+            return
+        needed_trains = {key[2] for key in needed}
+        trains = {t: c for t, c in TRAIN_CONFIG.items() if str(t) in needed_trains}
+
+    # Fetch all trains concurrently; the CSV work below stays single-threaded
+    with ThreadPoolExecutor(max_workers=len(trains)) as executor:
+        futures = {}
+        for train_num, config in trains.items():
+            futures[train_num] = executor.submit(
+                fetch_realtime, train_num, config["stations"], frozenset(config["stations"])
+            )
+
+    pending = []
+    for train_num, config in trains.items():
+        print(f"\nFetching status for Train {train_num} ({config['route']})")
+
+        # A malformed payload for one train must not discard the others' rows
+        try:
+            rows, message = futures[train_num].result()
+        except Exception as e:
+            rows, message = [], f"Error processing data for Train {train_num}: {e}"
+        if message:
+            print(f"  {message}")
         if not rows:
             print("  No active train data available.")
             continue
 
         # Filter to target date if specified
         if target_date:
-            rows = [r for r in rows if r["date"] == target_date]
+            rows = [r for r in rows if r.date == target_date]
             if not rows:
                 print(f"  No data matching date {target_date}.")
                 continue
 
         # Deduplicate against existing CSV
-        new_rows = [r for r in rows if not date_already_recorded(r["date"], r["station"], train_num)]
+        new_rows = [r for r in rows if (r.date, r.station, str(train_num)) not in recorded]
         if not new_rows:
             print("  Data already recorded.")
             continue
 
-        append_rows(new_rows)
-        dates = sorted(set(r["date"] for r in new_rows))
-        print(f"  Added {len(new_rows)} records for date(s): {', '.join(dates)}")
+        pending.extend(new_rows)
+        print(f"  Found {len(new_rows)} new records.")
+
+    # Write every train's new rows with a single open/write/fsync
+    if pending:
+        dates = set()
+        append_rows(pending, recorded, dates)
+        print(f"\nAdded {len(pending)} records for date(s): {', '.join(sorted(dates))}")
 
 
 def main():
@@ -203,7 +333,13 @@ def main():
     args = parser.parse_args()
 
     init_csv()
-    run(args.date)
+    recorded = load_recorded_keys()
+    try:
+        run(recorded, args.date)
+    finally:
+        SESSION.close()
+    # recorded now covers the CSV including this run's appends
+    save_recorded_keys(recorded)
 
 
 if __name__ == "__main__":